@@ -1,9 +1,12 @@
 import errno
 import os.path
 import re
+from collections import deque
 from contextlib import contextmanager
+from functools import lru_cache
 from functools import partial
 from functools import wraps
+from itertools import islice
 
 import click
 from click import BadParameter
@@ -14,9 +17,12 @@ from click import UsageError
 
 import linesieve
 from .click_utils import Group
+from .click_utils import make_echo
 from .click_utils import REGEX
 from .click_utils import RegexType
+from .parsing import get_literal
 from .parsing import group_records
+from .parsing import iter_lines
 from .parsing import make_pipeline
 
 # references for common command-line option names:
@@ -100,7 +106,7 @@ def cli(ctx, **kwargs):
     # options reserved for future expansion:
     # -s --section --section-start
     # -e --section-end
-    # -n --section-name # same as annotate_lines() marker
+    # -n --section-name # same as split_sections() marker
     ctx.obj = {}
 
 
@@ -120,6 +126,10 @@ def process_pipeline(
     file = ctx.obj.get('file')
     if not file:
         file = click.get_text_stream('stdin')
+    elif isinstance(file, click.utils.LazyFile):
+        # the lazy file has its own encoding and errors attributes (None),
+        # which are not the ones of the file it opens
+        file = file.open()
 
     if file.isatty():
         # we are not using no_args_is_help=True, because as of click 8.1.3,
@@ -131,45 +141,52 @@ def process_pipeline(
 
         secho("linesieve: reading from terminal", dim=True, err=True)
 
+    # resolved once, so output_sections() and pipe flush the same stream
+    stdout = ctx.obj['stdout'] = click.get_text_stream('stdout', errors=None)
+
+    # output is not flushed after every line; flush it before waiting
+    # for more input, so lines from slow commands are not held back
+    lines = iter_lines(file, before_read=stdout.flush)
+
     process = ctx.obj.get('process')
     show = ctx.obj.get('show')
     hide = ctx.obj.get('hide')
 
-    processors = [p for p in processors if p]
+    processors = deque(p for p in processors if p)
 
     if record_start:
         group_records_processor = partial(
             group_records, record_start=record_start, record_end=record_end
         )
         group_records_processor.is_iter = True
-        processors.insert(0, ([], group_records_processor))
+        processors.appendleft(([], group_records_processor))
     elif record_end:
         raise UsageError("Option --record-end requires --record-start.")
 
-    if line_delay:
+    if line_delay or section_delay:
+        from time import sleep
 
-        def _line_delay(file):
-            from time import sleep
+    if line_delay:
 
-            for line in file:
+        def _line_delay(lines):
+            for line in lines:
                 sleep(line_delay)
                 yield line
 
-        file = _line_delay(file)
+        lines = _line_delay(lines)
 
     if section_delay:
 
         def _section_delay(lines):
-            from time import sleep
-
             sleep(section_delay)
             return lines
 
         _section_delay.is_iter = True
-        processors.insert(0, ([], _section_delay))
+        processors.appendleft(([], _section_delay))
 
     status, label = output_sections(
-        make_pipeline(file, section, success, failure, show, hide, processors)
+        make_pipeline(lines, section, success, failure, show, hide, processors),
+        stdout=stdout,
     )
 
     message = None
@@ -228,7 +245,7 @@ def process_pipeline(
     ctx.exit(returncode)
 
 
-def output_sections(groups, section_dot='.'):
+def output_sections(groups, section_dot='.', stdout=None):
     """Print (section, lines) pairs in a fancy way.
 
     >>> groups = [('', 'ab'), ('', ''), ('', ''), ('one', 'c'), ('', ''), (True, 'xyz')]
@@ -242,37 +259,79 @@ def output_sections(groups, section_dot='.'):
     (True, 'x')
 
     """
+    # echo() flushes after every call, which is slow for lots of lines;
+    # instead, we flush stdout once per section, and stderr after every write
+    # (here, stdout is flushed before we write to stderr, so ordering is kept;
+    # anything else writing to stderr, like pipe, must flush stdout first)
+
+    # errors=None gets us the streams echo() uses; with the default 'strict',
+    # click may wrap them in a new (line buffered!) text wrapper
+    if stdout is None:
+        stdout = click.get_text_stream('stdout', errors=None)
+    stderr = click.get_text_stream('stderr', errors=None)
+    write = make_echo(stdout)
+    write_err = make_echo(stderr)
+
+    def echo_err(message):
+        write_err(message)
+        stderr.flush()
+
+    # runs of dots are written all at once, unless someone is watching
+    live_dots = stderr.isatty()
+    dots = 0
+
+    def flush_dots():
+        nonlocal dots
+        if dots:
+            echo_err(style(section_dot * dots, dim=True))
+            dots = 0
+
+    # section names usually repeat, don't style them every time
+    @lru_cache(maxsize=256)
+    def format_section(section):
+        return style(section, dim=True, bold=True) + '\n'
+
     prev_section = None
     last_was_dot = False
 
-    for section, lines in groups:
-        if section == '' and prev_section is not None:
-            secho(section_dot, dim=True, err=True, nl=False)
-            last_was_dot = True
-        elif last_was_dot:
-            echo(err=True)
-            last_was_dot = False
+    try:
+        for section, lines in groups:
+            if section == '' and prev_section is not None:
+                dots += 1
+                if live_dots:
+                    flush_dots()
+                last_was_dot = True
+            elif last_was_dot:
+                flush_dots()
+                echo_err('\n')
+                last_was_dot = False
 
-        if section is True or section is False:
-            return section, next(iter(lines))
+            if section is True or section is False:
+                return section, next(iter(lines))
 
-        if section is None:
-            return section, prev_section
+            if section is None:
+                return section, prev_section
 
-        if section:
-            secho(section, dim=True, bold=True)
+            if section:
+                write(format_section(section))
 
-        line = next(lines, None)
-        if line:
-            if last_was_dot:
-                echo(err=True)
-                last_was_dot = False
-            echo(line)
+            line = next(lines, None)
+            if line:
+                if last_was_dot:
+                    flush_dots()
+                    echo_err('\n')
+                    last_was_dot = False
+                write(line + '\n')
 
-        for line in lines:
-            echo(line)
+            for line in lines:
+                write(line + '\n')
+
+            stdout.flush()
+            prev_section = section
 
-        prev_section = section
+    finally:
+        flush_dots()
+        stdout.flush()
 
 
 OPTIONS_REGEX = RegexType(re.DOTALL, with_options=True)
@@ -482,7 +541,8 @@ def pop(obj, all):
 @cli.command(short_help="Pipe sections to command.")
 @click.argument('command')
 @section_option
-def pipe(command):
+@click.pass_obj
+def pipe(obj, command):
     """Pipe lines to COMMAND and replace them with the output.
 
     COMMAND is executed once per section.
@@ -497,9 +557,14 @@ def pipe(command):
     """
     # alternate name: exec
 
+    import subprocess
+    import threading
+
     def pipe(lines):
-        import subprocess
-        import threading
+        # the command writes to stderr directly, so output lines before it
+        # (and before we wait for its output, see process_pipeline())
+        flush = obj['stdout'].flush
+        flush()
 
         process = subprocess.Popen(
             command,
@@ -518,8 +583,7 @@ def pipe(command):
         keyboard_interrupt = False
         try:
             with process.stdout:
-                for line in process.stdout:
-                    yield line.rstrip('\n')
+                yield from iter_lines(process.stdout, before_read=flush)
         except KeyboardInterrupt:
             keyboard_interrupt = True
             raise
@@ -534,6 +598,7 @@ def pipe(command):
                     f"linesieve pipe: {shlex.split(command)[0]} "
                     f"exited with status code {returncode}"
                 )
+                flush()
                 secho(message, fg='red', err=True)
 
     pipe.is_iter = True
@@ -542,9 +607,9 @@ def pipe(command):
 
 def stdin_write(lines, file):
     with handle_broken_pipe(), file, handle_broken_pipe():
+        write = file.write
         for line in lines:
-            file.write(line)
-            file.write('\n')
+            write(line + '\n')
 
 
 @contextmanager
@@ -587,14 +652,20 @@ def head(count):
         b
 
     """
-    from itertools import islice
 
     def head(lines):
         if count >= 0:
             return islice(lines, count)
         else:
-            # TODO: don't read in memory, use a temporary file
-            return iter(list(lines)[0:count])
+            return head_all_but_last(lines)
+
+    def head_all_but_last(lines):
+        # keep only the last -count lines in memory
+        lines = iter(lines)
+        buffer = deque(islice(lines, -count))
+        for line in lines:
+            yield buffer.popleft()
+            buffer.append(line)
 
     head.is_iter = True
     return head
@@ -634,8 +705,6 @@ def tail(count):
         c
 
     """
-    from itertools import islice
-    from collections import deque
 
     def tail(lines):
         if count <= 0:
@@ -690,19 +759,27 @@ def span(start, end, fixed_strings, ignore_case, verbose, invert_match, repl):
     # --end-with (mutually exclusive with --end-before)
     empty_match = re.search('.*', '')
 
+    start_search = start.search if start else None
+    end_search = end.search if end else None
+
     def match_span(lines):
         in_span = False
         in_span_changed = True
+        # the replacement for empty_match is always the same;
+        # expanded lazily, since it may fail (if REPL has group references)
+        empty_repl = None
 
         for line in lines:
-            start_match = start.search(line) if start else None
+            # outside a span, only start matters;
+            # inside a span, start matters only if end matches too
+            start_match = None
 
-            if start and start_match:
-                if not in_span:
+            if not in_span:
+                if start_search and (start_match := start_search(line)):
                     in_span = True
                     in_span_changed = True
-            elif end and end.search(line):
-                if in_span:
+            elif end_search and end_search(line):
+                if not (start_search and start_search(line)):
                     in_span = False
                     in_span_changed = True
 
@@ -710,11 +787,11 @@ def span(start, end, fixed_strings, ignore_case, verbose, invert_match, repl):
                 yield line
             elif repl is not None and in_span_changed:
                 if invert_match and start_match:
-                    repl_match = start_match
+                    yield start_match.expand(repl)
                 else:
-                    repl_match = empty_match
-
-                yield repl_match.expand(repl)
+                    if empty_repl is None:
+                        empty_repl = empty_match.expand(repl)
+                    yield empty_repl
                 in_span_changed = False
 
     match_span.is_iter = True
@@ -782,22 +859,63 @@ def match(ctx, pattern, fixed_strings, only_matching, invert_match, color):
             color=color,
         )[1]
 
-    def search(line):
-        if not only_matching:
-            if bool(pattern.search(line)) is not invert_match:
-                return line
-            return None
+    if not only_matching:
+        literal = get_literal(pattern)
+
+        if literal:
+
+            def search(line):
+                if (literal in line) is not invert_match:
+                    return line
+                return None
+
+            return search
+
+        # decide on --invert-match once, not for every line
+        pattern_search = pattern.search
+
+        if invert_match:
+
+            def search(line):
+                return None if pattern_search(line) else line
+
+        else:
+
+            def search(line):
+                return line if pattern_search(line) else None
+
+        return search
+
+    # findall() returns strings if there are less than two groups,
+    # and tuples of strings otherwise; decide how to format them only once
+    if color:
+        # style() once, instead of for every match
+        red_start, red_end = style('\0', fg='red').split('\0')
+
+    if pattern.groups < 2:
+        if color:
+
+            def format_match(match):
+                return red_start + match + red_end
+
         else:
-            matches = pattern.findall(line)
-            if matches:
-                lines = []
-                for match in matches:
-                    groups = (match,) if isinstance(match, str) else match
-                    if color:
-                        groups = [style(g, fg='red') for g in groups]
-                    lines.append('\t'.join(groups))
-                return '\n'.join(lines)
+            format_match = None
+    else:
+        if color:
+
+            def format_match(groups):
+                return '\t'.join([red_start + g + red_end for g in groups])
+
+        else:
+            format_match = '\t'.join
+
+    def search(line):
+        matches = pattern.findall(line)
+        if not matches:
             return None
+        if format_match:
+            matches = map(format_match, matches)
+        return '\n'.join(matches)
 
     return search
 
@@ -910,20 +1028,37 @@ def split(
         d
 
     """
+    # splitting past the last selected field is wasted work
+    # (except with groups, since re.split() returns them as fields too)
+    fields_max_split = max_split
+    if fields and all(f.stop is not None for f in fields):
+        needed = max(f.stop for f in fields)
+        fields_max_split = min(max_split, needed) if max_split else needed
+
     if delimiter is None or (fixed_strings and not ignore_case):
-        max_split = max_split or -1
+        max_split = fields_max_split or -1
 
         def split(line):
             return line.split(delimiter, max_split)
 
     else:
-        # TODO: optimization: if the pattern is a simple string ("aa"), use str.split()
         param = next(p for p in ctx.command.params if p.name == 'delimiter')
         pattern = OPTIONS_REGEX.convert(delimiter, param, ctx)
-        max_split = max_split or 0
+        literal = get_literal(pattern)
 
-        def split(line):
-            return pattern.split(line, max_split)
+        if literal:
+            max_split = fields_max_split or -1
+
+            def split(line):
+                return line.split(literal, max_split)
+
+        else:
+            if not pattern.groups:
+                max_split = fields_max_split
+            max_split = max_split or 0
+
+            def split(line):
+                return pattern.split(line, max_split)
 
     if not output_delimiter:
         if fixed_strings:
@@ -933,11 +1068,19 @@ def split(
 
     if not fields:
         join = output_delimiter.join
+    elif len(fields) == 1:
+        # the most common case; slices already handle lines with fewer fields
+        (field_slice,) = fields
+
+        def join(parts):
+            return output_delimiter.join(parts[field_slice])
+
     else:
 
         def join(parts):
+            # join() makes a list from a generator anyway
             return output_delimiter.join(
-                p for field_slice in fields for p in parts[field_slice]
+                [p for field_slice in fields for p in parts[field_slice]]
             )
 
     def processor(line):
@@ -1030,10 +1173,13 @@ def parse(patterns, fixed_strings, ignore_case, verbose, only_matching, json):
     # single invocation (repeating the command doesn't make sense with -o)
 
     if not json:
-        from itertools import chain
 
         def render_dict(data):
-            return '\t'.join(v or '' for v in chain.from_iterable(data.items()))
+            parts = []
+            for key, value in data.items():
+                parts.append(key)
+                parts.append(value or '')
+            return '\t'.join(parts)
 
         def render_list(data):
             return '\t'.join(v or '' for v in data)
@@ -1043,18 +1189,26 @@ def parse(patterns, fixed_strings, ignore_case, verbose, only_matching, json):
 
         render_dict = render_list = json_dumps
 
-    has_dunder = {p: any('__' in k for k in p.groupindex) for p in patterns}
+    dunder_plans = {
+        p: make_dunder_plan(p.groupindex)
+        for p in patterns
+        if any('__' in k for k in p.groupindex)
+    }
+
+    # groupdict() always makes a new dict, even if there are no named groups
+    has_named = {p: bool(p.groupindex) for p in patterns}
 
     def processor(line):
         for pattern in patterns:
             match = pattern.search(line)
             if not match:
                 continue
-            if groupdict := match.groupdict():
-                if has_dunder[pattern]:
-                    groupdict = rewrite_dunders(groupdict)
+            if has_named[pattern]:
+                groupdict = match.groupdict()
+                if plan := dunder_plans.get(pattern):
+                    groupdict = rewrite_dunders(groupdict, plan)
                 return render_dict(groupdict)
-            return render_list(match.groups() or [match.group()])
+            return render_list(match.groups() or (match.group(),))
         else:
             if not only_matching:
                 return line
@@ -1063,11 +1217,20 @@ def parse(patterns, fixed_strings, ignore_case, verbose, only_matching, json):
     return processor
 
 
-def rewrite_dunders(groupdict):
+def make_dunder_plan(names):
+    # the name parsing done once per pattern, for rewrite_dunders()
+    rv = []
+    for name in names:
+        key, dunder, maybe_value = name.partition('__')
+        rv.append((name, key, bool(dunder), maybe_value))
+    return rv
+
+
+def rewrite_dunders(groupdict, plan):
     rv = {}
-    for key, value in groupdict.items():
-        if '__' in key:
-            key, _, maybe_value = key.partition('__')
+    for name, key, is_dunder, maybe_value in plan:
+        value = groupdict[name]
+        if is_dunder:
             # first key has priority
             if rv.get(key) is not None:
                 continue
@@ -1100,9 +1263,28 @@ def sub(pattern, repl, fixed_strings, only_matching, color):
     if color:
         repl = style(repl, fg='red')
 
+    # str.replace() is much faster, but cannot expand group references
+    literal = get_literal(pattern)
+
+    if literal and '\\' not in repl:
+
+        def sub(line):
+            if literal not in line:
+                return None if only_matching else line
+            return line.replace(literal, repl)
+
+        return sub
+
+    if not only_matching:
+
+        def sub(line):
+            return pattern.sub(repl, line)
+
+        return sub
+
     def sub(line):
         line, subn = pattern.subn(repl, line)
-        if only_matching and not subn:
+        if not subn:
             return None
         return line
 
@@ -1174,17 +1356,24 @@ def sub_paths(include, modules, modules_skip, modules_recursive):
         ..two
 
     """
-    from glob import glob
+    from glob import iglob
     from braceexpand import braceexpand
     from .paths import shorten_paths, paths_to_modules, make_file_paths_re
 
-    paths = []
+    # a set, since overlapping patterns may match the same file more than once
+    paths = set()
     try:
         for unexpanded_pattern in include:
-            for pattern in braceexpand(unexpanded_pattern):
-                paths.extend(glob(pattern, recursive=True))
+            # braceexpand() also handles escapes and unbalanced braces
+            if any(c in unexpanded_pattern for c in '{}\\'):
+                patterns = braceexpand(unexpanded_pattern)
+            else:
+                patterns = [unexpanded_pattern]
+            for pattern in patterns:
+                paths.update(iglob(pattern, recursive=True))
     except ValueError as e:
         raise BadParameter(e, param_hint=['--include'])
+    paths = sorted(paths)
 
     replacements = shorten_paths(paths, os.sep, '...')
 
@@ -1197,13 +1386,29 @@ def sub_paths(include, modules, modules_skip, modules_recursive):
     if not replacements:
         return None
 
+    # style() once, instead of once per replacement
+    start, end = style('\0', fg='yellow').split('\0')
     for k, v in replacements.items():
-        replacements[k] = style(v, fg='yellow')
+        replacements[k] = start + v + end
 
     pattern_re = make_file_paths_re(paths, modules or ())
 
+    # match[0] and a bound method avoid some lookups for every match
+    get_replacement = replacements.__getitem__
+
     def repl(match):
-        return replacements[match.group(0)]
+        return get_replacement(match[0])
+
+    if len(replacements) == 1:
+        # the path must appear as-is for the pattern to match
+        (only_path,) = replacements
+
+        def sub_paths(line):
+            if only_path not in line:
+                return line
+            return pattern_re.sub(repl, line)
+
+        return sub_paths
 
     def sub_paths(line):
         return pattern_re.sub(repl, line)
@@ -1226,7 +1431,7 @@ def sub_cwd():
     min_length = 2
 
     path = os.getcwd()
-    if len(path.split(os.sep)) < min_length:
+    if path.count(os.sep) + 1 < min_length:
         return None
 
     from .paths import make_dir_path_re
@@ -1234,9 +1439,12 @@ def sub_cwd():
     pattern_re = make_dir_path_re(path)
 
     def repl(match):
-        return '' if match.group(1) is None else '.'
+        return '' if match[1] is None else '.'
 
     def sub_cwd(line):
+        # most lines don't contain the path at all
+        if path not in line:
+            return line
         return pattern_re.sub(repl, line)
 
     return sub_cwd
@@ -1261,7 +1469,7 @@ def sub_link(link):
     except OSError:
         return None
 
-    if len(path.split(os.sep)) < min_length:
+    if path.count(os.sep) + 1 < min_length:
         return None
 
     from .paths import make_dir_path_re
@@ -1269,9 +1477,12 @@ def sub_link(link):
     pattern_re = make_dir_path_re(path)
 
     def repl(match):
-        return (link + os.sep) if match.group(1) is None else link
+        return (link + os.sep) if match[1] is None else link
 
     def sub_link(line):
+        # most lines don't contain the path at all
+        if path not in line:
+            return line
         return pattern_re.sub(repl, line)
 
     return sub_link
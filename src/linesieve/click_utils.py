@@ -1,9 +1,13 @@
 import inspect
 import re
+import sys
 from contextlib import contextmanager
+from functools import partial
 
 import click
+from click import echo
 from click import style
+from click import unstyle
 
 
 class InitialArgsMixin:
@@ -97,6 +101,33 @@ def color_help(text):
     return re.sub(line_re, repl, text, flags=re.M)
 
 
+def make_echo(file, color=None):
+    """Return a function that works like echo(message, file=file, nl=False),
+    but does not flush the file after every call.
+
+    Whether to strip ANSI styles is decided once, here,
+    instead of on every call.
+
+    """
+    if sys.platform.startswith('win'):
+        # let click deal with colorama
+        return partial(echo, file=file, nl=False, color=color)
+
+    # same logic as echo(); use click.utils.should_strip_ansi
+    # (and not a direct import), so CliRunner(color=True) can patch it
+    color = click.globals.resolve_color_default(color)
+    if not click.utils.should_strip_ansi(file, color):
+        return file.write
+
+    def write(message):
+        # most messages have no styles, and unstyle() is a regex substitution
+        if '\x1b' in message:
+            message = unstyle(message)
+        file.write(message)
+
+    return write
+
+
 class ManFormatter(click.HelpFormatter):
     def __init__(self):
         super().__init__(4, max_width=999999)
@@ -1,4 +1,7 @@
+import codecs
+import io
 import re
+from collections import deque
 from functools import lru_cache
 from itertools import chain
 from itertools import groupby
@@ -6,7 +9,7 @@ from operator import itemgetter
 
 
 def make_pipeline(
-    file,
+    lines,
     section_pattern,
     success_pattern,
     failure_pattern,
@@ -14,10 +17,9 @@ def make_pipeline(
     exclude_patterns,
     line_filters,
 ):
-    groups = group_by_section(
-        annotate_lines(file, section_pattern, success_pattern, failure_pattern)
-    )
+    groups = split_sections(lines, section_pattern, success_pattern, failure_pattern)
 
+    @lru_cache
     def show_section(section):
         if exclude_patterns:
             if any(p.search(section) for p in exclude_patterns):
@@ -26,8 +28,10 @@ def make_pipeline(
             return any(p.search(section) for p in include_patterns)
         return True
 
+    # the previous (hidden) section is output only on failure
     end_is_failure = None not in {success_pattern, failure_pattern}
-    groups = filter_sections(groups, show_section, end_is_failure)
+    keep_previous = failure_pattern is not None
+    groups = filter_sections(groups, show_section, end_is_failure, keep_previous)
 
     @lru_cache
     def get_filters(section):
@@ -38,29 +42,85 @@ def make_pipeline(
         return rv
 
     groups = filter_lines(groups, get_filters)
-    groups = dedupe_blank_lines(groups)
 
     return groups
 
 
-MATCH_NOTHING_RE = re.compile('$nothing')
+def iter_lines(file, size=2**16, before_read=None):
+    """Iterate over the lines of a text file, without line endings.
+
+    If possible, read chunks of (up to) size bytes from the underlying
+    binary file, and split them into lines all at once. Only the data
+    already available is read, so this does not wait on pipes.
+
+    If given, before_read() is called before every chunk is read
+    (which may block until more data is available).
+
+    >>> file = io.TextIOWrapper(io.BytesIO(b'a\\r\\nb\\rc\\n\\nd'))
+    >>> list(iter_lines(file, size=2))
+    ['a', 'b', 'c', '', 'd']
+
+    Otherwise, fall back to iterating over the file.
+
+    >>> list(iter_lines(io.StringIO('a\\nb\\n')))
+    ['a', 'b']
+
+    """
+    read = getattr(getattr(file, 'buffer', None), 'read1', None)
+    # without an encoding, we can't decode the chunks the way the file would
+    if read is None or not getattr(file, 'encoding', None):
+        for line in file:
+            yield line.rstrip('\n')
+        return
+
+    # like a text file with universal newlines mode
+    decoder = codecs.getincrementaldecoder(file.encoding)(file.errors)
+    decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+
+    # accumulate the parts of the last (incomplete) line in a list,
+    # so lines spanning lots of chunks don't get concatenated repeatedly
+    parts = []
+
+    while True:
+        if before_read:
+            before_read()
+        chunk = read(size)
+        lines = decoder.decode(chunk, final=not chunk).split('\n')
+
+        if len(lines) > 1:
+            parts.append(lines[0])
+            lines[0] = ''.join(parts)
+            parts = [lines.pop()]
+            yield from lines
+        else:
+            parts.append(lines[0])
+
+        if not chunk:
+            break
+
+    last = ''.join(parts)
+    if last:
+        yield last
 
 
-def annotate_lines(lines, section_re=None, success_re=None, failure_re=None):
-    """Annotate lines with their corresponding section.
+def split_sections(lines, section_re=None, success_re=None, failure_re=None):
+    """Split lines (without line endings, see iter_lines())
+    into (section, lines) pairs.
     Stop when encountering a success/failure marker.
 
     The section and success/failure markers are considered to be one line.
+    Consecutive sections with the same name are merged.
 
-    Yield (section, line) pairs, one for each content line.
-    If a section is empty, yield exactly one (section, None) pair.
     The first section is always '', meaning "no section, yet".
+    Empty sections get () as lines. Otherwise, lines is an iterator
+    that reads from the same underlying iterator as split_sections();
+    any lines not consumed are skipped when advancing to the next pair.
 
     At the end, yield exactly one of:
 
-    * (True, label), if the success pattern matched
-    * (False, label), if the failure pattern matched
-    * (None, None), if the lines ended before any of the above matched
+    * (True, [label]), if the success pattern matched
+    * (False, [label]), if the failure pattern matched
+    * (None, ()), if the lines ended before any of the above matched
 
     The section and label are:
 
@@ -68,89 +128,157 @@ def annotate_lines(lines, section_re=None, success_re=None, failure_re=None):
     * the first captured group, if any
     * the entire match, otherwise
 
+    If there is more than one (unnamed) group, lines matching the section
+    pattern are not considered sections, and the success/failure label
+    is the entire match.
+
     >>> lines = ['0', 'one:', '1', 'two:', 'three:', '3', 'end']
-    >>> list(annotate_lines(lines, re.compile('(.*):$'), re.compile('end')))
-    [('', '0'), ('one', '1'), ('two', None), ('three', '3'), (True, 'end')]
+    >>> groups = split_sections(lines, re.compile('(.*):$'), re.compile('end'))
+    >>> [(s, list(ls)) for s, ls in groups]
+    [('', ['0']), ('one', ['1']), ('two', []), ('three', ['3']), (True, ['end'])]
 
-    >>> list(annotate_lines([]))
-    [('', None), (None, None)]
+    >>> list(split_sections([]))
+    [('', ()), (None, ())]
 
     """
-    section_re, success_re, failure_re = [
-        pattern if pattern is not None else MATCH_NOTHING_RE
-        for pattern in (section_re, success_re, failure_re)
-    ]
+    # most lines are not markers; don't search for markers we don't have,
+    # and for literal markers, do a (much faster) substring check first
+    failure_lit, success_lit, section_lit = (
+        (get_literal(pattern) or '') if pattern else ''
+        for pattern in (failure_re, success_re, section_re)
+    )
+
+    # unlike section markers, success/failure markers always have a label
+    failure_label, success_label = (
+        get_label_getter(pattern, required=True) if pattern else None
+        for pattern in (failure_re, success_re)
+    )
+    section_label = get_label_getter(section_re) if section_re else None
+
+    # avoid attribute lookups in the loop
+    failure_search, success_search, section_search = (
+        pattern.search if pattern else None
+        for pattern in (failure_re, success_re, section_re)
+    )
+
+    lines = iter(lines)
+
+    # set by get_lines() when it stops: the next section name
+    # (or True / False / None, if done), and the success/failure label
+    next_section = None
+    end_label = None
+
+    def get_lines(section):
+        nonlocal next_section, end_label
+
+        for line in lines:
+            if (
+                failure_search
+                and failure_lit in line
+                and (match := failure_search(line))
+            ):
+                next_section = False
+                end_label = failure_label(match)
+                return
+
+            if (
+                success_search
+                and success_lit in line
+                and (match := success_search(line))
+            ):
+                next_section = True
+                end_label = success_label(match)
+                return
+
+            if (
+                section_search
+                and section_lit in line
+                and (match := section_search(line))
+            ):
+                label = section_label(match)
+                if label:
+                    if label == section:
+                        continue
+                    next_section = label
+                    return
+
+            yield line
+
+        next_section = None
 
-    done = False
-    ok = None
     section = ''
-    yielded_lines = False
-    for line in chain(lines, [None]):
-        if line is not None:
-            line = line.rstrip('\n')
-
-        match = None
-        label = None
-
-        if line is None:
-            done = True
-        elif match := failure_re.search(line):
-            done = True
-            ok = False
-        elif match := success_re.search(line):
-            done = True
-            ok = True
-        elif match := section_re.search(line):
-            pass
-
-        if match:
-            if not match.re.groups:
-                label = match.group()
-            elif 'name' in match.re.groupindex:
-                label = match.group('name')
-            elif match.re.groups == 1:
-                label = match.group(1)
-
-        if done:
-            if not yielded_lines:
-                yield section, None
-            yield ok, label
+    while True:
+        section_lines = get_lines(section)
+        first = next(section_lines, None)
+
+        if first is None:
+            yield section, ()
+        else:
+            yield section, chain([first], section_lines)
+            # skip whatever the consumer did not use
+            deque(section_lines, maxlen=0)
+
+        if next_section is True or next_section is False:
+            yield next_section, [end_label]
+            break
+        if next_section is None:
+            yield None, ()
             break
 
-        if label:
-            if not yielded_lines:
-                yield section, None
-            section = label
-            yielded_lines = False
-            continue
+        section = next_section
 
-        yielded_lines = True
-        yield section, line
 
+def get_label_getter(pattern, required=False):
+    """Return a function that gets the label from a match of pattern
+    (see split_sections() for details).
 
-def group_by_section(pairs):
-    """Group annotate_lines() output into (section, lines) pairs.
+    If there is no label (more than one unnamed group),
+    the function returns None, or the entire match if required is true.
 
-    >>> pairs = [('', '0'), ('', '1'), ('section', None), (True, 'end')]
-    >>> groups = group_by_section(pairs)
-    >>> [(s, list(ls)) for s, ls in groups]
-    [('', ['0', '1']), ('section', []), (True, ['end'])]
+    >>> get_label = get_label_getter(re.compile('(?P<name>a)(b)'))
+    >>> get_label(re.search('(?P<name>a)(b)', 'ab'))
+    'a'
+    >>> get_label = get_label_getter(re.compile('(a)(b)'), required=True)
+    >>> get_label(re.search('(a)(b)', 'ab'))
+    'ab'
 
     """
-    get_one = itemgetter(1)
+    # match[index] with an int index is the cheapest way to get a group
+    if not pattern.groups:
+        return itemgetter(0)
+    if 'name' in pattern.groupindex:
+        return itemgetter(pattern.groupindex['name'])
+    if pattern.groups == 1:
+        return itemgetter(1)
+    if required:
+        return itemgetter(0)
+    return lambda match: None
 
-    for section, group in groupby(pairs, itemgetter(0)):
-        lines = map(get_one, group)
-        first = next(lines, None)
 
-        if first is None:
-            yield section, ()
-            continue
+LITERAL_RE = re.compile(r"(?:[^.^$*+?{}\[\]\\|()]|\\[^0-9A-Za-z])*")
+ESCAPE_RE = re.compile(r"\\(.)", re.DOTALL)
+
 
-        yield section, chain([first], lines)
+def get_literal(pattern):
+    """If pattern only matches a literal string, return the string.
+    Otherwise, return None.
 
+    >>> get_literal(re.compile('one: two'))
+    'one: two'
+    >>> get_literal(re.compile(re.escape('(a.b)')))
+    '(a.b)'
+    >>> get_literal(re.compile('a.b'))
+    >>> get_literal(re.compile('ab', re.IGNORECASE))
 
-def filter_sections(groups, predicate, end_is_failure=True):
+    """
+    if pattern.flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+    if not LITERAL_RE.fullmatch(pattern.pattern):
+        return None
+    return ESCAPE_RE.sub(r'\1', pattern.pattern)
+
+
+def filter_sections(groups, predicate, end_is_failure=True, keep_previous=True):
     """Filter (section, lines) pairs.
 
     If predicate(section) is true, yield the pair as-is.
@@ -160,21 +288,21 @@ def filter_sections(groups, predicate, end_is_failure=True):
     and the section before-last did not match the predicate,
     yield the before-last pair (again) as-is before the last one.
 
+    If keep_previous is false, don't do the above; the lines
+    of sections that did not match are not kept around.
+
     >>> groups = [('1', 'i'), ('two', 'ii'), ('three', 'iii'), (None, '')]
     >>> groups = filter_sections(groups, str.isdigit)
     >>> list(groups)
     [('1', 'i'), ('', ()), ('', ()), ('three', ['i', 'i', 'i']), (None, '')]
 
     """
-    last_before = {False}
-    if end_is_failure:
-        last_before.add(None)
-
     previous = None
 
     for section, lines in groups:
-        if section in {True, False, None}:
-            if section in last_before and previous is not None:
+        if section is True or section is False or section is None:
+            output_previous = section is False or (section is None and end_is_failure)
+            if output_previous and previous is not None:
                 yield previous
             yield section, lines
             break
@@ -184,70 +312,106 @@ def filter_sections(groups, predicate, end_is_failure=True):
             previous = None
         else:
             yield '', ()
-            previous = section, list(lines)
+            if keep_previous:
+                previous = section, list(lines)
 
 
 def filter_lines(groups, get_filters):
     """Filter the lines in (section, lines) pairs.
 
+    Also deduplicate blank lines (and remove leading ones).
+
     >>> groups = [('one', 'a1B2')]
     >>> groups = filter_lines(groups, lambda _: [str.isalpha, str.upper])
     >>> [(s, list(ls)) for s, ls in groups]
     [('one', ['A', 'B'])]
 
+    >>> groups = [('one', ['', '1', '', '', '', '2', ''])]
+    >>> groups = filter_lines(groups, lambda _: [])
+    >>> [(s, list(ls)) for s, ls in groups]
+    [('one', ['1', '', '2', ''])]
+
     """
 
     def filter_lines(lines, filters):
+        if len(filters) == 1:
+            # the most common case; avoid the inner loop
+            (filter,) = filters
+            for line in lines:
+                rv = filter(line)
+                if rv is line or rv is True:
+                    yield line
+                elif rv is not False and rv is not None:
+                    yield rv
+            return
+
         for line in lines:
             for filter in filters:
                 rv = filter(line)
-                if rv is True:
+                # most of the time, filters return the line unchanged
+                if rv is line or rv is True:
                     continue
-                if rv is False:
+                if rv is False or rv is None:
                     line = None
-                else:
-                    line = rv
-                if line is None:
                     break
+                line = rv
             if line is not None:
                 yield line
 
-    for section, lines in groups:
-        if section not in {True, False, None}:
-            filters = get_filters(section)
-            grouped = groupby(filters, key=lambda f: getattr(f, 'is_iter', False))
-
-            for is_iter, group in grouped:
-                if is_iter:
-                    for filter in group:
-                        lines = filter(lines)
-                else:
-                    lines = filter_lines(lines, list(group))
-
-        yield section, lines
-
+    def filter_and_dedupe_lines(lines, filters):
+        # same as filter_lines() followed by deduplication,
+        # but without an extra generator for every line to go through
+        only_filter = filters[0] if len(filters) == 1 else None
+        prev_blank = True
+        for line in lines:
+            if only_filter:
+                rv = only_filter(line)
+                if rv is not line and rv is not True:
+                    if rv is False or rv is None:
+                        continue
+                    line = rv
+            else:
+                for filter in filters:
+                    rv = filter(line)
+                    if rv is line or rv is True:
+                        continue
+                    if rv is False or rv is None:
+                        line = None
+                        break
+                    line = rv
+                if line is None:
+                    continue
 
-def dedupe_blank_lines(groups):
-    """Deduplicate blank lines in (section, lines) pairs.
+            # unlike strip(), isspace() does not allocate a new string
+            blank = not line or line.isspace()
+            if not (blank and prev_blank):
+                yield line
+            prev_blank = blank
 
-    >>> groups = [('one', ['', '1', '', '', '', '2', ''])]
-    >>> groups = dedupe_blank_lines(groups)
-    >>> [(s, list(ls)) for s, ls in groups]
-    [('one', ['1', '', '2', ''])]
+    @lru_cache
+    def get_runs(section):
+        filters = get_filters(section)
+        grouped = groupby(filters, key=lambda f: getattr(f, 'is_iter', False))
+        runs = [(is_iter, list(group)) for is_iter, group in grouped]
 
-    """
+        # deduplication happens in the last run of line filters
+        if not runs or runs[-1][0]:
+            runs.append((False, []))
 
-    def dedupe(lines):
-        prev_line = ''
-        for line in lines:
-            stripped = line.strip()
-            if not (prev_line == line.strip() == ''):
-                yield line
-            prev_line = stripped
+        return runs
 
     for section, lines in groups:
-        if section not in {True, False, None}:
-            lines = dedupe(lines)
+        if not (section is True or section is False or section is None):
+            runs = get_runs(section)
+            for i, (is_iter, group) in enumerate(runs, 1):
+                if is_iter:
+                    for filter in group:
+                        lines = filter(lines)
+                elif i < len(runs):
+                    lines = filter_lines(lines, group)
+                else:
+                    lines = filter_and_dedupe_lines(lines, group)
+
         yield section, lines
 
 
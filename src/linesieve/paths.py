@@ -3,13 +3,16 @@ import re
 
 
 def shorten_paths(paths, sep, ellipsis):
-    shortened = {path: path.split(sep) for path in paths}
+    parts = {path: path.split(sep) for path in paths}
+    # _do_end() and _do_start() set the parts to keep to None
+    masks = {path: list(path_parts) for path, path_parts in parts.items()}
 
-    _do_end(shortened.values(), 0, -1)
+    _do_end(masks.values(), 0, -1)
 
-    for original, mask in shortened.items():
+    shortened = {}
+    for original, mask in masks.items():
         path = []
-        for ps, ms in zip(original.split(sep), mask):
+        for ps, ms in zip(parts[original], mask):
             if ms is None:
                 path.append(ps)
             else:
@@ -97,24 +100,66 @@ def make_dir_path_re(*paths):
 def make_file_paths_re(paths, modules=()):
     patterns = []
 
-    paths = sorted(paths, key=lambda p: -len(p))
     if paths:
         patterns.append(
             fr"""
             {NON_PATH_START}
-            (?: {'|'.join(map(re.escape, paths))} )
+            (?: {make_prefix_tree_re(paths)} )
             {NON_PATH_END}
             """
         )
 
-    modules = sorted(modules, key=lambda p: -len(p))
     if modules:
         patterns.append(
             fr"""
             (?:^|\b)
-            (?: { '|'.join(map(re.escape, modules)) } )
+            (?: {make_prefix_tree_re(modules)} )
             (?:\b|$)
             """
         )
 
     return re.compile('\n|\n'.join(patterns), re.VERBOSE)
+
+
+def make_prefix_tree_re(strings):
+    """Return a pattern that matches any of strings, longest first.
+
+    Common prefixes are matched only once, instead of the regex engine
+    trying every one of the strings at every position.
+
+    >>> make_prefix_tree_re(['ab', 'abc', 'ad', 'x'])
+    '(?:a(?:b(?:c)?|d)|x)'
+
+    """
+    # '' marks the end of a string (no character is '')
+    root = {}
+    for string in strings:
+        node = root
+        for char in string:
+            node = node.setdefault(char, {})
+        node[''] = None
+    return _render_prefix_tree(root)
+
+
+def _render_prefix_tree(node):
+    branches = []
+    for char, child in node.items():
+        if not char:
+            continue
+        # collapse runs of characters without branches
+        prefix = char
+        while len(child) == 1 and '' not in child:
+            ((char, child),) = child.items()
+            prefix += char
+        branches.append(re.escape(prefix) + _render_prefix_tree(child))
+
+    if not branches:
+        return ''
+    if len(branches) == 1 and '' not in node:
+        return branches[0]
+
+    # greedy, so longer strings are tried first
+    rv = f"(?:{'|'.join(branches)})"
+    if '' in node:
+        rv += '?'
+    return rv
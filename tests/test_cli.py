@@ -1,5 +1,9 @@
+import os
 import pathlib
+import select
 import shlex
+import subprocess
+import sys
 from textwrap import dedent
 
 import click
@@ -42,7 +46,9 @@ DATA = dict(load_data(ROOT))
 
 
 @pytest.mark.parametrize('args, input, output', list(DATA.values()), ids=list(DATA))
-def test_data(args, input, output):
+def test_data(args, input, output, monkeypatch):
+    # so data files can be referred to as data/...
+    monkeypatch.chdir(ROOT)
     runner = CliRunner()
     result = runner.invoke(cli, args, input, catch_exceptions=False)
     assert click.unstyle(result.output) == output
@@ -219,3 +225,48 @@ def test_split_field_slices(input, output):
 def test_split_field_slices_error(input):
     with pytest.raises(ValueError):
         split_field_slices(input)
+
+
+# CliRunner uses BytesIO streams, which hide when output is flushed;
+# also, PYTHONUNBUFFERED would make stdout write through on every write
+
+LINESIEVE = [sys.executable, '-m', 'linesieve']
+BUFFERED_ENV = {k: v for k, v in os.environ.items() if k != 'PYTHONUNBUFFERED'}
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="select() needs sockets")
+def test_output_not_held_back_while_waiting_for_input():
+    process = subprocess.Popen(
+        LINESIEVE,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=BUFFERED_ENV,
+    )
+    try:
+        process.stdin.write(b'one\n')
+        process.stdin.flush()
+
+        ready, _, _ = select.select([process.stdout], [], [], 10)
+        assert ready, "line held back while waiting for input"
+        assert process.stdout.readline() == b'one\n'
+
+    finally:
+        process.stdin.close()
+        process.wait()
+
+
+def test_pipe_output_order():
+    command = 'cat; sleep .5; echo stderr >&2; exit 3'
+    process = subprocess.run(
+        LINESIEVE + ['pipe', command],
+        input=b'one\ntwo\n',
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=BUFFERED_ENV,
+    )
+    assert process.stdout.decode().splitlines() == [
+        'one',
+        'two',
+        'stderr',
+        'linesieve pipe: cat; exited with status code 3',
+    ]
@@ -1,5 +1,8 @@
+import re
+
 import pytest
 
+from linesieve.paths import make_prefix_tree_re
 from linesieve.paths import paths_to_modules
 from linesieve.paths import shorten_paths
 
@@ -59,3 +62,29 @@ def test_paths_to_modules(skip, recursive, output):
     assert paths_to_modules(MODULE_PATHS, skip=skip, recursive=recursive) == set(
         output.split()
     )
+
+
+PREFIX_TREE_STRINGS = """
+src/one/mod.py
+src/one/mod.pyc
+src/one/two/mod.py
+src/one.py
+src/on
+tst/mod.py
+a+b(c).py
+""".split()
+
+
+@pytest.mark.parametrize(
+    'text',
+    [
+        "src/one/mod.pyc src/one/two/mod.py src/one.py src/o src/on",
+        "xsrc/one/mod.pyx tst/mod.py tst/mod.p a+b(c).py ab(c).py",
+        "",
+    ],
+)
+def test_make_prefix_tree_re(text):
+    """Same matches as an alternation sorted longest first."""
+    strings = sorted(PREFIX_TREE_STRINGS, key=lambda s: -len(s))
+    expected = re.findall('|'.join(map(re.escape, strings)), text)
+    assert re.findall(make_prefix_tree_re(PREFIX_TREE_STRINGS), text) == expected